@@ -5,14 +5,26 @@ FastAPI + Telethon for Telegram MTProto communication
 
 import os
 import asyncio
+import hmac
 import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from typing import Optional
 from fastapi import FastAPI, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict
 from telethon import TelegramClient
 from telethon.sessions import StringSession
-from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError
+from telethon.errors import (
+    AuthKeyError,
+    AuthKeyUnregisteredError,
+    SessionPasswordNeededError,
+    PhoneCodeInvalidError,
+)
+import aiofiles
 import uvicorn
 
 # Configure logging
@@ -24,37 +36,92 @@ API_ID = int(os.getenv("TELEGRAM_API_ID", "0"))
 API_HASH = os.getenv("TELEGRAM_API_HASH", "")
 API_KEY = os.getenv("API_KEY", "your-secret-api-key")
 SESSION_FILE = os.getenv("SESSION_FILE", "session.txt")
+ALLOWED_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "http://localhost:3000").split(",") if o.strip()]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Connect the Telegram client on startup, disconnect on shutdown"""
+    global _authorized
+
+    logger.info("Starting Telegram client...")
+    try:
+        tc = await get_client()
+        logger.info("Telegram client initialized")
+
+        # Pre-warm: pull auth state and resolve the bot now so the first
+        # /rera/lookup doesn't pay for the handshake and username resolve
+        if await tc.is_user_authorized():
+            _authorized = True
+            await tc.get_me()
+            await get_bot(tc)
+            logger.info("Client pre-warmed and bot resolved")
+    except Exception as e:
+        logger.error("Failed to initialize client: %s", e)
+
+    yield
+
+    if client:
+        await client.disconnect()
+
 
 # FastAPI app
-app = FastAPI(title="Telegram RERA Lookup API")
+app = FastAPI(title="Telegram RERA Lookup API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # CORS
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+# Compress large text responses (bot replies); small payloads pass through
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
 # Global client and state
 client: Optional[TelegramClient] = None
-phone_code_hash: Optional[str] = None
-pending_phone: Optional[str] = None
+
+# Pending auth codes: phone -> (phone_code_hash, expiry timestamp)
+_pending: dict = {}
+PENDING_TTL = 300  # seconds a sent code stays valid locally
+
+BOT_USERNAME = "AtlasDubaiBot"
+_bot_entity = None  # cached InputPeer for the bot
+_client_lock = asyncio.Lock()
+# All lookups share the one bot chat; serialize conversations so concurrent
+# distinct lookups queue instead of hitting AlreadyInConversationError
+_conversation_lock = asyncio.Lock()
+_last_saved_session: Optional[str] = None
+_authorized: bool = False  # set once startup/sign-in verifies the session
+
+# RERA lookup response cache: rera_number -> (response dict, expiry timestamp)
+_rera_cache: OrderedDict = OrderedDict()
+RERA_CACHE_TTL = 3600  # seconds
+RERA_CACHE_MAX = 1024  # entries, oldest evicted first
+
+# In-flight lookups: rera_number -> future, so concurrent duplicates share one conversation
+_inflight: dict = {}
 
 
 # Request/Response models
 class PhoneRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, extra="ignore", frozen=True)
+
     phone: str
 
 
 class VerifyCodeRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, extra="ignore", frozen=True)
+
     phone: str
     code: str
     password: Optional[str] = None
 
 
 class RERARequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, extra="ignore", frozen=True)
+
     rera_number: str
 
 
@@ -65,54 +132,76 @@ class StatusResponse(BaseModel):
 
 # API Key authentication
 async def verify_api_key(x_api_key: str = Header(...)):
-    if x_api_key != API_KEY:
+    # Compare as bytes: compare_digest rejects non-ASCII str, and header
+    # values may carry arbitrary latin-1 bytes
+    supplied = (x_api_key or "").encode("utf-8", "surrogateescape")
+    if not hmac.compare_digest(supplied, API_KEY.encode()):
         raise HTTPException(status_code=401, detail="Invalid API key")
     return x_api_key
 
 
-def load_session() -> str:
+async def load_session() -> str:
     """Load session string from file if exists"""
-    if os.path.exists(SESSION_FILE):
-        with open(SESSION_FILE, "r") as f:
-            return f.read().strip()
+    global _last_saved_session
+
+    if await asyncio.to_thread(os.path.exists, SESSION_FILE):
+        async with aiofiles.open(SESSION_FILE, "r") as f:
+            _last_saved_session = (await f.read()).strip()
+            return _last_saved_session
     return ""
 
 
-def save_session(session_string: str):
-    """Save session string to file"""
-    with open(SESSION_FILE, "w") as f:
-        f.write(session_string)
+async def save_session(session_string: str):
+    """Save session string to file, skipping unchanged writes"""
+    global _last_saved_session
+
+    if session_string == _last_saved_session:
+        return
+
+    async with aiofiles.open(SESSION_FILE, "w") as f:
+        await f.write(session_string)
+    _last_saved_session = session_string
 
 
 async def get_client() -> TelegramClient:
     """Get or create Telegram client"""
     global client
-    
-    if client is None:
-        session_string = load_session()
-        client = TelegramClient(StringSession(session_string), API_ID, API_HASH)
-        await client.connect()
-    
+
+    if client is not None:
+        return client
+
+    async with _client_lock:
+        # Re-check under the lock: another request may have connected first
+        if client is None:
+            session_string = await load_session()
+            # Tight retry/timeout budget: callers are waiting synchronously,
+            # so bound worst-case latency on a DC hiccup instead of backing off
+            tc = TelegramClient(
+                StringSession(session_string),
+                API_ID,
+                API_HASH,
+                connection_retries=2,
+                retry_delay=1,
+                timeout=8,
+                request_retries=2,
+                auto_reconnect=True,
+            )
+            # Publish only after connect succeeds so a failed connect leaves
+            # client None and the next request retries
+            await tc.connect()
+            client = tc
+
     return client
 
 
-@app.on_event("startup")
-async def startup():
-    """Initialize client on startup"""
-    logger.info("Starting Telegram client...")
-    try:
-        await get_client()
-        logger.info("Telegram client initialized")
-    except Exception as e:
-        logger.error(f"Failed to initialize client: {e}")
+async def get_bot(tc: TelegramClient):
+    """Get the bot input entity, resolving the username only once"""
+    global _bot_entity
 
+    if _bot_entity is None:
+        _bot_entity = await tc.get_input_entity(BOT_USERNAME)
 
-@app.on_event("shutdown")
-async def shutdown():
-    """Disconnect client on shutdown"""
-    global client
-    if client:
-        await client.disconnect()
+    return _bot_entity
 
 
 @app.get("/health")
@@ -135,50 +224,54 @@ async def get_session_status(_: str = Depends(verify_api_key)):
         
         return StatusResponse(authenticated=is_authorized, phone=phone)
     except Exception as e:
-        logger.error(f"Status check error: {e}")
+        logger.error("Status check error: %s", e)
         return StatusResponse(authenticated=False)
 
 
 @app.post("/auth/start")
 async def start_auth(request: PhoneRequest, _: str = Depends(verify_api_key)):
     """Start phone authentication - sends code to Telegram"""
-    global phone_code_hash, pending_phone
-    
     try:
         tc = await get_client()
-        
+
         # Check if already authenticated
         if await tc.is_user_authorized():
             return {"success": True, "message": "Already authenticated", "code_sent": False}
-        
+
         # Send code
         result = await tc.send_code_request(request.phone)
-        phone_code_hash = result.phone_code_hash
-        pending_phone = request.phone
-        
-        logger.info(f"Code sent to {request.phone}")
+
+        # Sweep expired entries, then record this phone's pending code
+        now = time.monotonic()
+        for phone in [p for p, (_, expiry) in _pending.items() if expiry < now]:
+            del _pending[phone]
+        _pending[request.phone] = (result.phone_code_hash, now + PENDING_TTL)
+
+        logger.info("Code sent to %s", request.phone)
         return {"success": True, "message": "Code sent to Telegram", "code_sent": True}
     
     except Exception as e:
-        logger.error(f"Auth start error: {e}")
+        logger.error("Auth start error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.post("/auth/verify")
 async def verify_code(request: VerifyCodeRequest, _: str = Depends(verify_api_key)):
     """Verify the code received on Telegram"""
-    global client, phone_code_hash, pending_phone
-    
+    global _authorized
+
     try:
         tc = await get_client()
-        
-        # Use stored hash or require it matches pending phone
-        if pending_phone != request.phone:
-            raise HTTPException(status_code=400, detail="Phone number mismatch. Start auth again.")
-        
-        if not phone_code_hash:
+
+        entry = _pending.get(request.phone)
+        if entry is None:
             raise HTTPException(status_code=400, detail="No pending verification. Start auth first.")
-        
+
+        phone_code_hash, expiry = entry
+        if expiry < time.monotonic():
+            del _pending[request.phone]
+            raise HTTPException(status_code=400, detail="Verification expired. Start auth again.")
+
         try:
             await tc.sign_in(request.phone, request.code, phone_code_hash=phone_code_hash)
         except SessionPasswordNeededError:
@@ -191,101 +284,143 @@ async def verify_code(request: VerifyCodeRequest, _: str = Depends(verify_api_ke
         
         # Save session
         session_string = tc.session.save()
-        save_session(session_string)
+        await save_session(session_string)
         
         # Clear pending state
-        phone_code_hash = None
-        pending_phone = None
-        
+        _pending.pop(request.phone, None)
+        _authorized = True
+
         logger.info("Successfully authenticated")
         return {"success": True, "message": "Successfully authenticated"}
     
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Verify error: {e}")
+        logger.error("Verify error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.post("/rera/lookup")
 async def lookup_rera(request: RERARequest, _: str = Depends(verify_api_key)):
     """Send RERA number to @AtlasDubaiBot and get response"""
+    global _authorized
+
     try:
         tc = await get_client()
+
+        # Trust the cached flag; only round-trip when it's unset
+        if not _authorized:
+            if not await tc.is_user_authorized():
+                raise HTTPException(status_code=401, detail="Not authenticated with Telegram")
+            _authorized = True
         
-        if not await tc.is_user_authorized():
-            raise HTTPException(status_code=401, detail="Not authenticated with Telegram")
-        
-        bot_username = "AtlasDubaiBot"
-        rera_number = request.rera_number.strip()
-        
-        logger.info(f"Looking up RERA: {rera_number}")
-        
-        # Get the bot entity
+        rera_number = request.rera_number
+
+        # Serve repeat lookups from the cache
+        cached = _rera_cache.get(rera_number)
+        if cached:
+            result, expiry = cached
+            if expiry > time.monotonic():
+                _rera_cache.move_to_end(rera_number)
+                logger.debug("Cache hit for RERA: %s", rera_number)
+                return result
+            del _rera_cache[rera_number]
+
+        # Coalesce concurrent lookups for the same number into one conversation
+        inflight = _inflight.get(rera_number)
+        if inflight is not None:
+            logger.debug("Joining in-flight lookup for RERA: %s", rera_number)
+            return await inflight
+
+        future = asyncio.get_running_loop().create_future()
+        _inflight[rera_number] = future
+
         try:
-            bot = await tc.get_entity(bot_username)
-        except Exception as e:
-            logger.error(f"Could not find bot: {e}")
-            raise HTTPException(status_code=404, detail=f"Could not find @{bot_username}")
-        
-        # Send the RERA number
-        await tc.send_message(bot, rera_number)
-        logger.info(f"Sent RERA to bot: {rera_number}")
-        
-        # Wait for response (with timeout)
-        await asyncio.sleep(3)  # Give bot time to respond
-        
-        # Get recent messages from bot
-        messages = await tc.get_messages(bot, limit=5)
-        
-        # Find the response (should be after our message)
-        response_text = None
-        for msg in messages:
-            if msg.out:  # Skip our own messages
-                continue
-            response_text = msg.text
-            break
-        
-        if response_text:
-            logger.info(f"Got response from bot")
-            return {
-                "success": True,
-                "rera_number": rera_number,
-                "response": response_text
-            }
-        else:
-            return {
-                "success": True,
-                "rera_number": rera_number,
-                "response": "No response received from bot yet. Please try again in a moment."
-            }
+            logger.info("Looking up RERA: %s", rera_number)
+
+            # Get the bot entity (cached after first resolve)
+            try:
+                bot = await get_bot(tc)
+            except Exception as e:
+                logger.error("Could not find bot: %s", e)
+                raise HTTPException(status_code=404, detail=f"Could not find @{BOT_USERNAME}")
+
+            # Send the RERA number and wait for the bot's reply
+            response_text = None
+            try:
+                async with _conversation_lock:
+                    async with tc.conversation(bot, timeout=10) as conv:
+                        await conv.send_message(rera_number)
+                        logger.debug("Sent RERA to bot: %s", rera_number)
+                        response = await conv.get_response()
+                        response_text = response.text
+            except asyncio.TimeoutError:
+                logger.warning("Bot did not respond within timeout for: %s", rera_number)
+
+            if response_text:
+                logger.debug("Got response from bot")
+                result = {
+                    "success": True,
+                    "rera_number": rera_number,
+                    "response": response_text
+                }
+                # Cache successful responses only, capped to bound memory
+                _rera_cache[rera_number] = (result, time.monotonic() + RERA_CACHE_TTL)
+                _rera_cache.move_to_end(rera_number)
+                while len(_rera_cache) > RERA_CACHE_MAX:
+                    _rera_cache.popitem(last=False)
+            else:
+                result = {
+                    "success": True,
+                    "rera_number": rera_number,
+                    "response": "No response received from bot yet. Please try again in a moment."
+                }
+
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            # Hand the failure to coalesced waiters as well
+            future.set_exception(e)
+            future.exception()  # mark retrieved in case no one is waiting
+            raise
+        finally:
+            _inflight.pop(rera_number, None)
     
     except HTTPException:
         raise
+    except (AuthKeyError, AuthKeyUnregisteredError) as e:
+        # Session was revoked outside this process; drop the cached flag so
+        # the next request re-validates instead of failing forever
+        _authorized = False
+        logger.error("Telegram auth key invalid: %s", e)
+        raise HTTPException(status_code=401, detail="Not authenticated with Telegram")
     except Exception as e:
-        logger.error(f"RERA lookup error: {e}")
+        logger.error("RERA lookup error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/auth/logout")
 async def logout(_: str = Depends(verify_api_key)):
     """Logout and clear session"""
-    global client
-    
+    global client, _bot_entity, _last_saved_session, _authorized
+
     try:
+        _authorized = False
         if client:
             await client.log_out()
             client = None
+        _bot_entity = None
+        _last_saved_session = None
         
-        # Remove session file
-        if os.path.exists(SESSION_FILE):
-            os.remove(SESSION_FILE)
+        # Remove session file without blocking the event loop
+        if await asyncio.to_thread(os.path.exists, SESSION_FILE):
+            await asyncio.to_thread(os.remove, SESSION_FILE)
         
         return {"success": True, "message": "Logged out"}
     except Exception as e:
-        logger.error(f"Logout error: {e}")
+        logger.error("Logout error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools", workers=1)